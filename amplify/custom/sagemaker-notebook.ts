@@ -106,6 +106,7 @@ export function createSageMakerNotebook(scope: Construct, bucket: IBucket) {
   // Get configuration from environment variables
   const sagemakerModelName = process.env.SAGEMAKER_MODEL_NAME || 'bird-species-detection-model';
   const sagemakerRegion = process.env.SAGEMAKER_REGION || 'us-east-1';
+  const endpointInstanceType = process.env.SAGEMAKER_ENDPOINT_INSTANCE_TYPE || '';
   const stackRegion = Stack.of(scope).region;
   const notebookName = 'bird-species-classifier-notebook-v4';
 
@@ -121,7 +122,8 @@ export function createSageMakerNotebook(scope: Construct, bucket: IBucket) {
     model_name: sagemakerModelName,
     notebook_name: notebookName,
     s3_region: stackRegion,
-    sagemaker_region: sagemakerRegion
+    sagemaker_region: sagemakerRegion,
+    endpoint_instance_type: endpointInstanceType
   };
   
   // Replace placeholders in lifecycle script
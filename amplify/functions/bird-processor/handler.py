@@ -1,31 +1,109 @@
 import boto3
-import base64
+import concurrent.futures
+import functools
 import json
-import csv
 import io
-import zipfile
 import time
 import re
-import hashlib
 import logging
 import os
+import queue
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
 from urllib.parse import unquote_plus
 
-# Configure logging
+# Configure logging - per-image messages are DEBUG, so set LOG_LEVEL=DEBUG to see them
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Concurrency uses threads over the runtime's bundled boto3 rather than asyncio/aioboto3:
+# the function is deployed from this directory without installing requirements, and
+# boto3 releases the GIL while waiting on Bedrock/S3, so workers scale with this setting
+BEDROCK_PARALLELISM = int(os.environ.get("BEDROCK_PARALLELISM", "16"))  # Concurrent Claude workers
+S3_UPLOAD_PARALLELISM = 32  # Concurrent extracted-image uploads
+CLAUDE_IMAGES_PER_REQUEST = int(os.environ.get("CLAUDE_IMAGES_PER_REQUEST", "5"))  # Bedrock allows up to 20
+PIPELINE_QUEUE_SIZE = 64  # Extracted images waiting for a worker
+PROGRESS_LOG_INTERVAL = 50  # Log progress every 50 images
+ZIP_SPOOL_MAX_MEMORY = 64 * 1024 * 1024  # ZIPs larger than 64MB are spooled to /tmp
+ZIP_READ_BUFFER_SIZE = 512 * 1024  # 512KB reads when scanning large ZIPs
+
+# One Bedrock client shared by all worker threads; the pool must be at least as
+# large as the worker count or requests stall waiting for a free connection
+bedrock_config = Config(
+    max_pool_connections=max(BEDROCK_PARALLELISM, 10),
+    retries={"mode": "adaptive", "max_attempts": 8},
+    read_timeout=60,
+    connect_timeout=5,
+    tcp_keepalive=True
+)
+
+# S3 client shared by the upload workers and the Claude workers
+s3_config = Config(
+    max_pool_connections=S3_UPLOAD_PARALLELISM + BEDROCK_PARALLELISM,
+    retries={"mode": "standard", "max_attempts": 5}
+)
+# Only images above the multipart threshold go through the transfer manager. Parts upload
+# on the calling thread: the upload pool already supplies the parallelism, and nested
+# threads would oversubscribe the S3 connection pool
+IMAGE_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=False)
 
-s3 = boto3.client("s3")
-bedrock = boto3.client("bedrock-runtime", region_name=os.environ.get("BEDROCK_REGION", "us-west-2"))
 MODEL_ID = os.environ.get("CLAUDE_MODEL_ID", "global.anthropic.claude-sonnet-4-20250514-v1:0")
+CLAUDE_CACHE_PREFIX = "cache/claude-counts/"  # S3 prefix for bird counts keyed by image SHA-256
+
+# The instruction is identical for every image, so it goes in the system prompt ahead of
+# a cache point; Bedrock can then reuse the cached prefix instead of billing it per call
+BIRD_COUNT_PROMPT = "Count the number of birds in this image. Respond with ONLY a number, nothing else."
+BIRD_COUNT_SYSTEM_PROMPT = [
+    {"text": BIRD_COUNT_PROMPT},
+    {"cachePoint": {"type": "default"}}
+]
+
+# Several images can share one request to cut per-call overhead and Bedrock RPM usage;
+# images go in order and Claude answers with one count per line
+BIRD_BATCH_COUNT_PROMPT = (
+    "You will be shown several numbered images. For each image, in order, count the number "
+    "of birds in it. Respond with one integer per line, one line per image, nothing else."
+)
+BIRD_BATCH_COUNT_SYSTEM_PROMPT = [
+    {"text": BIRD_BATCH_COUNT_PROMPT},
+    {"cachePoint": {"type": "default"}}
+]
+
+# The reply is a single number: greedy decoding keeps it deterministic and the small
+# token cap cuts off any trailing text Claude might add
+BIRD_COUNT_INFERENCE_CONFIG = {
+    "maxTokens": 5,
+    "temperature": 0.0
+}
+
+# Clients are created on first use rather than at import to keep cold starts short.
+# boto3's default session isn't safe to build clients from concurrently, hence the lock
+_client_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    with _client_lock:
+        return boto3.client("s3", config=s3_config)
 
-BATCH_SIZE = 50  # Process 50 images at a time
+@functools.lru_cache(maxsize=1)
+def get_bedrock_client():
+    with _client_lock:
+        return boto3.client("bedrock-runtime", region_name=os.environ.get("BEDROCK_REGION", "us-west-2"), config=bedrock_config)
+
+@functools.lru_cache(maxsize=1)
+def get_sagemaker_client(region):
+    with _client_lock:
+        return boto3.client('sagemaker', region_name=region)
 
 # Security configurations
 MAX_FILE_SIZE = 5 * 1024 * 1024 * 1024  # 5GB
 MAX_ZIP_ENTRIES = 10000  # Maximum number of files in a ZIP
 ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
+_ALLOWED_EXT_TUPLE = tuple(ALLOWED_IMAGE_EXTENSIONS)  # str.endswith accepts a tuple
 MALICIOUS_PATTERNS = [
     r'\.\./',  # Path traversal
     r'<script',  # XSS attempts
@@ -38,13 +116,20 @@ MALICIOUS_PATTERNS = [
     r'\.pif$',  # Program information files
 ]
 
+# Compiled once at import - these run for every entry in a ZIP
+_MALICIOUS_RE = re.compile('|'.join(MALICIOUS_PATTERNS), re.IGNORECASE)
+_SANITIZE_RE = re.compile(r'[^\w\-_\.]')
+_NUMBER_RE = re.compile(r'\d+')
+# __MACOSX/ folders, AppleDouble "._" files, .DS_Store and Thumbs.db
+_MAC_METADATA_RE = re.compile(r'^(?:__macosx/|\.ds_store|\._)|/\._|\.ds_store$|^thumbs\.db$', re.IGNORECASE)
+
 def validate_filename_security(filename):
     """Validate filename for security issues"""
     # Check for malicious patterns
-    for pattern in MALICIOUS_PATTERNS:
-        if re.search(pattern, filename, re.IGNORECASE):
-            logger.warning(f"Malicious pattern detected in filename: {filename} - pattern: {pattern}")
-            return False
+    match = _MALICIOUS_RE.search(filename)
+    if match:
+        logger.warning(f"Malicious pattern detected in filename: {filename} - match: {match.group(0)}")
+        return False
     
     # Check filename length
     if len(filename) > 255:
@@ -64,7 +149,7 @@ def sanitize_filename(filename):
     filename = filename.split('/')[-1]
     
     # Replace dangerous characters with underscores
-    sanitized = re.sub(r'[^\w\-_\.]', '_', filename)
+    sanitized = _SANITIZE_RE.sub('_', filename)
     
     # Ensure it doesn't start with a dot (hidden file)
     if sanitized.startswith('.'):
@@ -79,179 +164,267 @@ def sanitize_filename(filename):
     return sanitized
 
 def validate_zip_security(zip_file):
-    """Validate ZIP file for security issues"""
-    file_count = 0
-    total_uncompressed_size = 0
-    
-    for file_info in zip_file.filelist:
-        file_count += 1
-        
-        # Check for zip bomb (too many files)
-        if file_count > MAX_ZIP_ENTRIES:
-            logger.error(f"ZIP file contains too many entries: {file_count}")
-            return False, "ZIP file contains too many entries"
-        
-        # Check for zip bomb (excessive uncompressed size)
-        total_uncompressed_size += file_info.file_size
-        if total_uncompressed_size > MAX_FILE_SIZE * 10:  # Allow 10x expansion
-            logger.error(f"ZIP file uncompressed size too large: {total_uncompressed_size}")
-            return False, "ZIP file uncompressed size too large"
-        
-        # Check compression ratio for potential zip bomb
-        if file_info.compress_size > 0:
-            ratio = file_info.file_size / file_info.compress_size
-            if ratio > 100:  # Suspicious compression ratio
-                logger.warning(f"Suspicious compression ratio for {file_info.filename}: {ratio}")
-        
-        # Validate filename
-        if not validate_filename_security(file_info.filename):
-            return False, f"Malicious filename detected: {file_info.filename}"
+    """Validate ZIP limits and every entry before any entry is read.
+    
+    Only central-directory metadata is inspected, so the whole archive is vetted up
+    front and nothing is uploaded or sent to Claude from an archive that would fail.
+    """
+    # Check for zip bomb (too many files) - the central directory is already parsed
+    entries = zip_file.infolist()
+    if len(entries) > MAX_ZIP_ENTRIES:
+        logger.error(f"ZIP file contains too many entries: {len(entries)}")
+        return False, "ZIP file contains too many entries"
+    
+    validation_state = {'total_uncompressed_size': 0}
+    for file_info in entries:
+        is_valid, validation_message = validate_zip_entry(file_info, validation_state)
+        if not is_valid:
+            return False, validation_message
     
     return True, "ZIP file validation passed"
 
+def validate_zip_entry(file_info, state):
+    """Validate a single ZIP entry for security issues, tracking running totals in state"""
+    # Check for zip bomb (excessive uncompressed size)
+    state['total_uncompressed_size'] += file_info.file_size
+    if state['total_uncompressed_size'] > MAX_FILE_SIZE * 10:  # Allow 10x expansion
+        logger.error(f"ZIP file uncompressed size too large: {state['total_uncompressed_size']}")
+        return False, "ZIP file uncompressed size too large"
+    
+    # Check compression ratio for potential zip bomb
+    if file_info.compress_size > 0:
+        ratio = file_info.file_size / file_info.compress_size
+        if ratio > 100:  # Suspicious compression ratio
+            logger.warning(f"Suspicious compression ratio for {file_info.filename}: {ratio}")
+    
+    # Validate filename
+    if not validate_filename_security(file_info.filename):
+        return False, f"Malicious filename detected: {file_info.filename}"
+    
+    return True, "ZIP entry validation passed"
+
 def is_image_file(filename):
     """Check if file is an image based on extension with security validation"""
     if not validate_filename_security(filename):
         return False
     
-    extension = '.' + filename.lower().split('.')[-1] if '.' in filename else ''
-    return extension in ALLOWED_IMAGE_EXTENSIONS
+    return filename.lower().endswith(_ALLOWED_EXT_TUPLE)
 
 def is_mac_metadata_file(filename):
     """Check if file is Mac metadata that should be skipped"""
-    filename = filename.lower()
-    return (
-        filename.startswith('__macosx/') or
-        filename.startswith('.ds_store') or
-        filename.endswith('.ds_store') or
-        filename.startswith('._') or
-        '/._' in filename or
-        filename == 'thumbs.db'
-    )
+    return _MAC_METADATA_RE.search(filename) is not None
 
-def process_image_with_claude(image_bytes, filename):
-    """Process single image with Claude and return bird count with retry logic"""
-    max_retries = 3
-    base_delay = 1  # Start with 1 second delay
-    
-    print(f"🔍 Processing image {filename}")
-    import sys
-    sys.stdout.flush()
+def detect_image_format(image_bytes):
+    """Return the Converse image format from the file's magic bytes, or None if Claude can't read it"""
+    header = image_bytes[:12]
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG'):
+        return 'png'
+    if header.startswith(b'GIF8'):
+        return 'gif'
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return 'webp'
+    # BMP (b'BM') and anything unrecognised is not accepted by Claude
+    return None
+
+def get_cached_bird_count(bucket, image_hash):
+    """Return the stored Claude bird count for an image hash, or None if not cached"""
+    try:
+        s3_obj = get_s3_client().get_object(Bucket=bucket, Key=f"{CLAUDE_CACHE_PREFIX}{image_hash}.json")
+        cached = json.loads(s3_obj["Body"].read())
+    except get_s3_client().exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logger.warning(f"Could not read Claude cache entry {image_hash}: {str(e)}")
+        return None
     
-    for attempt in range(max_retries):
-        try:
-            image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-            
-            body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": image_base64
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": "Count the number of birds in this image. Respond with ONLY a number, nothing else."
-                            }
-                        ]
+    # Counts from a different model are treated as a miss
+    if cached.get("model_id") != MODEL_ID:
+        return None
+    return cached.get("bird_count")
+
+def put_cached_bird_count(bucket, image_hash, bird_count):
+    """Store a Claude bird count keyed by the image hash"""
+    try:
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=f"{CLAUDE_CACHE_PREFIX}{image_hash}.json",
+            Body=json.dumps({"bird_count": bird_count, "model_id": MODEL_ID}),
+            ContentType="application/json",
+            ServerSideEncryption='AES256'
+        )
+    except Exception as e:
+        logger.warning(f"Could not write Claude cache entry {image_hash}: {str(e)}")
+
+def request_bird_count(image_bytes, image_format, filename):
+    """Ask Claude for the bird count in one image; raises ValueError if the reply has no number"""
+    # Converse takes the image format per content block; botocore base64-encodes the bytes
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "image": {
+                        "format": image_format,
+                        "source": {"bytes": image_bytes}
                     }
-                ],
-                "max_tokens": 10
-            }
+                }
+            ]
+        }
+    ]
+    
+    logger.debug(f"🤖 Calling Claude AI for bird counting: {filename}...")
+    
+    response = get_bedrock_client().converse(
+        modelId=MODEL_ID,
+        system=BIRD_COUNT_SYSTEM_PROMPT,
+        messages=messages,
+        inferenceConfig=BIRD_COUNT_INFERENCE_CONFIG
+    )
+    
+    logger.debug(f"✅ Claude AI response received for {filename}")
+    
+    response_text = response["output"]["message"]["content"][0]["text"].strip()
+    
+    # Try to extract just the number
+    numbers = _NUMBER_RE.findall(response_text)
+    if not numbers:
+        raise ValueError(f"No number found in response: {response_text}")
+    return int(numbers[0])
 
-            print(f"🤖 Calling Claude AI for bird counting: {filename}...")
-            sys.stdout.flush()
-            
-            response = bedrock.invoke_model(
-                modelId=MODEL_ID,
-                contentType="application/json",
-                accept="application/json",
-                body=json.dumps(body)
-            )
-            
-            print(f"✅ Claude AI response received for {filename}")
-            sys.stdout.flush()
+def request_batch_bird_counts(pending):
+    """Ask Claude for bird counts in several images with one request.
+    
+    pending holds (position, filename, image_bytes, image_format, image_hash) tuples.
+    Raises ValueError unless the reply has exactly one count per image.
+    """
+    content = []
+    for number, (_, _, image_bytes, image_format, _) in enumerate(pending, start=1):
+        content.append({"text": f"Image {number}:"})
+        content.append({"image": {"format": image_format, "source": {"bytes": image_bytes}}})
+    content.append({"text": f"There are {len(pending)} images. Output {len(pending)} lines."})
+    
+    logger.debug(f"🤖 Calling Claude AI for bird counting on {len(pending)} images...")
+    
+    response = get_bedrock_client().converse(
+        modelId=MODEL_ID,
+        system=BIRD_BATCH_COUNT_SYSTEM_PROMPT,
+        messages=[{"role": "user", "content": content}],
+        inferenceConfig={"maxTokens": 8 * len(pending), "temperature": 0.0}
+    )
+    
+    response_text = response["output"]["message"]["content"][0]["text"].strip()
+    
+    # One count per line; take the last number on each line so "Image 2: 5" reads as 5
+    counts = []
+    for line in response_text.splitlines():
+        numbers = _NUMBER_RE.findall(line)
+        if numbers:
+            counts.append(int(numbers[-1]))
+    if len(counts) != len(pending):
+        raise ValueError(f"Expected {len(pending)} counts in response: {response_text}")
+    return counts
 
-            result = json.loads(response["body"].read())
-            response_text = result["content"][0]["text"].strip()
-            
-            # Try to extract just the number
-            import re
-            numbers = re.findall(r'\d+', response_text)
-            if numbers:
-                bird_count = int(numbers[0])
-            else:
-                raise ValueError(f"No number found in response: {response_text}")
-            
-            print(f"🐦 {filename}: {bird_count} birds detected by Claude AI")
-            sys.stdout.flush()
-            return bird_count
-            
+def process_image_batch(images, cache_bucket=None):
+    """Count birds in a list of (filename, image_bytes) with as few Claude requests as possible.
+    
+    Returns counts in input order, 0 for images that can't be counted. Unsupported and
+    cached images never reach Bedrock; the rest share one request, and if that request
+    fails or its reply doesn't line up, each image is sent on its own instead.
+    """
+    counts = [0] * len(images)
+    pending = []
+    
+    for position, (filename, image_bytes) in enumerate(images):
+        logger.debug(f"🔍 Processing image {filename}")
+        
+        # Claude rejects mislabeled or unsupported images, so check the real format up front
+        # rather than sending a request that can never succeed
+        image_format = detect_image_format(image_bytes)
+        if image_format is None:
+            logger.warning(f"⚠️ Unsupported image format for Claude: {filename}, returning 0")
+            continue
+        
+        image_hash = None
+        if cache_bucket:
+            import hashlib
+            image_hash = hashlib.sha256(image_bytes).hexdigest()
+            cached_count = get_cached_bird_count(cache_bucket, image_hash)
+            if cached_count is not None:
+                logger.debug(f"🐦 {filename}: {cached_count} birds (cached Claude AI result)")
+                counts[position] = cached_count
+                continue
+        
+        pending.append((position, filename, image_bytes, image_format, image_hash))
+    
+    batch_counts = None
+    if len(pending) > 1:
+        try:
+            batch_counts = request_batch_bird_counts(pending)
         except Exception as e:
-            print(f"⚠️ Attempt {attempt + 1} failed for {filename}: {str(e)}")
-            sys.stdout.flush()
-            
-            # If this was the last attempt, return 0
-            if attempt == max_retries - 1:
-                print(f"❌ All {max_retries} attempts failed for {filename}, returning 0")
-                sys.stdout.flush()
-                return 0
-            
-            # Exponential backoff: wait 1s, then 2s, then 4s
-            delay = base_delay * (2 ** attempt)
-            print(f"⏳ Retrying in {delay} seconds...")
-            sys.stdout.flush()
-            time.sleep(delay)
+            logger.warning(f"⚠️ Batch request for {len(pending)} images failed: {str(e)}, counting individually")
+    
+    # Throttling and 5xx errors are retried inside botocore (adaptive mode on the shared
+    # client), so anything raised here is either a non-retryable error or retries ran out
+    for i, (position, filename, image_bytes, image_format, image_hash) in enumerate(pending):
+        if batch_counts is not None:
+            bird_count = batch_counts[i]
+        else:
+            try:
+                bird_count = request_bird_count(image_bytes, image_format, filename)
+            except ValueError as e:
+                logger.warning(f"⚠️ Could not read bird count for {filename}: {str(e)}, returning 0")
+                continue
+            except Exception as e:
+                logger.error(f"❌ Claude AI call failed for {filename}: {str(e)}, returning 0")
+                continue
+        
+        logger.debug(f"🐦 {filename}: {bird_count} birds detected by Claude AI")
+        counts[position] = bird_count
+        if image_hash:
+            put_cached_bird_count(cache_bucket, image_hash, bird_count)
     
-    return 0
+    return counts
+
+def process_image_with_claude(image_bytes, filename, cache_bucket=None):
+    """Process single image with Claude and return bird count, or 0 if it can't be counted.
+    
+    When cache_bucket is given, counts are cached in S3 by SHA-256 of the image bytes
+    so re-uploaded or duplicate images skip the Bedrock call.
+    """
+    return process_image_batch([(filename, image_bytes)], cache_bucket=cache_bucket)[0]
 
 def save_results_to_s3_csv(bucket, results, extraction_folder):
     """Save bird count results to public/results/ folder - NO MOCK DATA"""
     timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S")
     csv_key = f"public/results/bird-results-{timestamp}.csv"
     
-    # Simple header with only real data from Claude AI
-    header = ["filename", "bird_count", "extraction_folder"]
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(header)
-    
-    for filename, bird_count in results:
-        row = [filename, bird_count, extraction_folder]
-        writer.writerow(row)
+    # Simple header with only real data from Claude AI. Filenames and the extraction
+    # folder have been through sanitize_filename, so no field needs CSV quoting
+    lines = ["filename,bird_count,extraction_folder\n"]
+    lines.extend(f"{filename},{bird_count},{extraction_folder}\n" for filename, bird_count in results)
     
     # Add server-side encryption
-    s3.put_object(
+    get_s3_client().put_object(
         Bucket=bucket,
         Key=csv_key,
-        Body=output.getvalue().encode("utf-8"),
+        Body="".join(lines).encode("utf-8"),
         ContentType="text/csv",
         ServerSideEncryption='AES256'
     )
     
     print(f"📁 Created CSV with REAL Claude AI results: {csv_key} with {len(results)} results")
-    import sys
-    sys.stdout.flush()
     
     # Log real summary
     total_birds = sum(bird_count for _, bird_count in results)
     images_with_birds = sum(1 for _, bird_count in results if bird_count > 0)
     print(f"📊 REAL Claude AI Summary: {len(results)} images processed, {total_birds} total birds detected, {images_with_birds} images contain birds")
-    sys.stdout.flush()
     
     # Trigger SageMaker processing for enhanced species classification
     print("🚀 About to trigger SageMaker processing...")
-    sys.stdout.flush()
     trigger_sagemaker_processing(bucket, csv_key, extraction_folder)
     print("✅ SageMaker trigger attempt completed")
-    sys.stdout.flush()
 
 def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
     """Trigger SageMaker notebook for species classification with improved reliability"""
@@ -260,7 +433,7 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
         current_region = os.environ.get('AWS_REGION', 'us-west-2')
         
         # Create SageMaker client
-        sagemaker = boto3.client('sagemaker', region_name=current_region)
+        sagemaker = get_sagemaker_client(current_region)
         
         # Create parameter file for SageMaker with dynamic paths
         params = {
@@ -275,7 +448,7 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
         }
         
         params_key = "sagemaker/processing_params.json"
-        s3.put_object(
+        get_s3_client().put_object(
             Bucket=bucket,
             Key=params_key,
             Body=json.dumps(params),
@@ -284,8 +457,6 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
         )
         logger.info(f"💾 Saved SageMaker parameters: {params_key}")
         print(f"💾 Saved SageMaker parameters: {params_key}")
-        import sys
-        sys.stdout.flush()
         
         # Create trigger file for daemon
         trigger_data = {
@@ -295,7 +466,7 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
         }
         
         trigger_key = "triggers/run_classification"
-        s3.put_object(
+        get_s3_client().put_object(
             Bucket=bucket,
             Key=trigger_key,
             Body=json.dumps(trigger_data),
@@ -303,109 +474,56 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
             ServerSideEncryption='AES256'
         )
         print(f"🎯 Created daemon trigger: {trigger_key}")
-        sys.stdout.flush()
         
-        # Start SageMaker notebook instance with improved status handling
+        # Start the SageMaker notebook if it is idle. A Pending or InService notebook is left
+        # alone: the lifecycle script runs the classifier in the background, and it re-checks
+        # the trigger file above right before it stops the notebook
         notebook_name = "bird-species-classifier-notebook-v4"
         print(f"🔍 Checking SageMaker notebook: {notebook_name}")
-        sys.stdout.flush()
         
-        max_retries = 3
-        retry_count = 0
+        response = sagemaker.describe_notebook_instance(NotebookInstanceName=notebook_name)
+        status = response['NotebookInstanceStatus']
+        print(f"📊 Current notebook status: {status}")
         
-        while retry_count < max_retries:
+        if status == 'Stopping':
+            # Too late for the script to see the trigger, so wait for the stop and start again
+            print("⏳ Notebook is stopping, waiting to restart it...")
             try:
-                # Check notebook status
-                response = sagemaker.describe_notebook_instance(NotebookInstanceName=notebook_name)
-                status = response['NotebookInstanceStatus']
-                print(f"📊 Current notebook status: {status} (attempt {retry_count + 1}/{max_retries})")
-                sys.stdout.flush()
-                
-                if status == 'Stopped':
-                    print("🚀 Starting stopped notebook...")
-                    sagemaker.start_notebook_instance(NotebookInstanceName=notebook_name)
-                    print(f"✅ Notebook start initiated: {notebook_name}")
-                    print("📝 Lifecycle script will run automatically and stop notebook when done")
-                    break
-                    
-                elif status == 'InService':
-                    print(f"⚠️ Notebook already running: {notebook_name}")
-                    print("🔄 Stopping and restarting to trigger fresh processing...")
-                    
-                    # Stop the notebook
-                    sagemaker.stop_notebook_instance(NotebookInstanceName=notebook_name)
-                    print("⏳ Waiting for notebook to stop...")
-                    
-                    # Wait for it to stop with timeout
-                    waiter = sagemaker.get_waiter('notebook_instance_stopped')
-                    waiter.wait(
-                        NotebookInstanceName=notebook_name, 
-                        WaiterConfig={'Delay': 30, 'MaxAttempts': 15}  # 7.5 minutes max
-                    )
-                    print("✅ Notebook stopped")
-                    
-                    # Start it again
-                    print("🚀 Starting notebook to trigger processing...")
-                    sagemaker.start_notebook_instance(NotebookInstanceName=notebook_name)
-                    print("✅ Notebook restart initiated - improved lifecycle script will auto-stop")
-                    break
-                    
-                elif status in ['Starting', 'Stopping']:
-                    print(f"⏳ Notebook in transition state: {status}")
-                    if retry_count < max_retries - 1:
-                        print(f"⏳ Waiting 60 seconds before retry...")
-                        time.sleep(60)
-                        retry_count += 1
-                        continue
-                    else:
-                        print("⚠️ Max retries reached, creating delayed trigger")
-                        retry_key = f"sagemaker/delayed_trigger_{int(time.time())}.json"
-                        retry_data = {
-                            "action": "delayed_processing",
-                            "csv_key": csv_key,
-                            "extraction_folder": extraction_folder,
-                            "current_status": status,
-                            "timestamp": datetime.utcnow().isoformat(),
-                            "note": "Notebook was in transition state, manual intervention may be needed"
-                        }
-                        s3.put_object(
-                            Bucket=bucket,
-                            Key=retry_key,
-                            Body=json.dumps(retry_data),
-                            ContentType="application/json",
-                            ServerSideEncryption='AES256'
-                        )
-                        print(f"📝 Created delayed trigger: {retry_key}")
-                        break
-                        
-                else:
-                    print(f"❌ Unexpected notebook status: {status}")
-                    if retry_count < max_retries - 1:
-                        print("🔄 Attempting to start notebook anyway...")
-                        try:
-                            sagemaker.start_notebook_instance(NotebookInstanceName=notebook_name)
-                            print("🚀 Start command sent")
-                            break
-                        except Exception as start_error:
-                            print(f"⚠️ Start failed: {str(start_error)}")
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                time.sleep(30)
-                    else:
-                        print("❌ All retry attempts failed")
-                        break
-                        
-            except Exception as status_error:
-                print(f"❌ Error checking notebook status: {str(status_error)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    print(f"⏳ Retrying in 30 seconds... ({retry_count}/{max_retries})")
-                    time.sleep(30)
-                else:
-                    raise status_error
-                    
-        import sys
-        sys.stdout.flush()
+                waiter = sagemaker.get_waiter('notebook_instance_stopped')
+                waiter.wait(NotebookInstanceName=notebook_name, WaiterConfig={'Delay': 15, 'MaxAttempts': 20})
+                status = 'Stopped'
+            except Exception as wait_error:
+                print(f"⚠️ Notebook did not stop in time: {str(wait_error)}")
+        
+        if status == 'Stopped':
+            print("🚀 Starting stopped notebook...")
+            sagemaker.start_notebook_instance(NotebookInstanceName=notebook_name)
+            print(f"✅ Notebook start initiated: {notebook_name}")
+            print("📝 Lifecycle script will run automatically and stop notebook when done")
+            
+        elif status in ['InService', 'Pending']:
+            print(f"✅ Notebook already {status}: {notebook_name}")
+            print("📝 Classification script will pick up the new trigger before stopping")
+            
+        else:
+            print(f"⚠️ Notebook in state {status}, creating delayed trigger")
+            retry_key = f"sagemaker/delayed_trigger_{int(time.time())}.json"
+            retry_data = {
+                "action": "delayed_processing",
+                "csv_key": csv_key,
+                "extraction_folder": extraction_folder,
+                "current_status": status,
+                "timestamp": datetime.utcnow().isoformat(),
+                "note": "Notebook could not be started from its current state, manual intervention may be needed"
+            }
+            get_s3_client().put_object(
+                Bucket=bucket,
+                Key=retry_key,
+                Body=json.dumps(retry_data),
+                ContentType="application/json",
+                ServerSideEncryption='AES256'
+            )
+            print(f"📝 Created delayed trigger: {retry_key}")
                 
     except sagemaker.exceptions.ClientError as e:
             if 'does not exist' in str(e):
@@ -420,7 +538,7 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
                     "message": "SageMaker notebook instance does not exist",
                     "timestamp": datetime.utcnow().isoformat()
                 }
-                s3.put_object(
+                get_s3_client().put_object(
                     Bucket=bucket,
                     Key=error_key,
                     Body=json.dumps(error_data),
@@ -433,105 +551,197 @@ def trigger_sagemaker_processing(bucket, csv_key, extraction_folder):
                 import traceback
                 print(f"🔍 Error traceback: {traceback.format_exc()}")
                 raise e
-            import sys
-            sys.stdout.flush()
                 
     except Exception as e:
         logger.error(f"❌ Failed to trigger SageMaker processing: {str(e)}")
         print(f"❌ Failed to trigger SageMaker processing: {str(e)}")
         import traceback
         print(f"🔍 SageMaker error traceback: {traceback.format_exc()}")
-        import sys
-        sys.stdout.flush()
         # Don't fail the main processing if SageMaker trigger fails
 
-def process_zip_file(bucket, key):
-    """Process ZIP file with security validations"""
-    logger.info(f"📦 Processing ZIP file: {key}")
-    
-    # Download ZIP file from S3
-    s3_obj = s3.get_object(Bucket=bucket, Key=key)
-    zip_bytes = s3_obj["Body"].read()
-    
-    # Validate ZIP file security
-    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zip_file:
-        is_valid, validation_message = validate_zip_security(zip_file)
-        if not is_valid:
-            logger.error(f"Security validation failed for {key}: {validation_message}")
-            raise ValueError(f"ZIP security validation failed: {validation_message}")
+def iter_image_entries(zip_file):
+    """Yield (clean_filename, data) for each image in the ZIP, reading one entry at a time.
+    
+    Expects an archive that has already passed validate_zip_security.
+    """
+    for file_info in zip_file.infolist():
+        if file_info.is_dir():
+            continue
+            
+        filename = file_info.filename
         
-        # Extract and filter image files
-        image_files = []
-        for file_info in zip_file.filelist:
-            if file_info.is_dir():
-                continue
-                
-            filename = file_info.filename
+        # Skip Mac metadata files
+        if is_mac_metadata_file(filename):
+            logger.debug(f"🗑️ Skipping Mac metadata: {filename}")
+            continue
             
-            # Skip Mac metadata files
-            if is_mac_metadata_file(filename):
-                logger.info(f"🗑️ Skipping Mac metadata: {filename}")
-                continue
-                
-            # Skip non-image files
-            if not is_image_file(filename):
-                logger.info(f"⏭️ Skipping non-image: {filename}")
+        # Skip non-image files - names were vetted by validate_zip_security,
+        # so only the extension needs checking here
+        if not filename.lower().endswith(_ALLOWED_EXT_TUPLE):
+            logger.debug(f"⏭️ Skipping non-image: {filename}")
+            continue
+        
+        try:
+            with zip_file.open(file_info) as entry:
+                image_data = entry.read()
+        except Exception as e:
+            logger.error(f"❌ Error extracting {filename}: {str(e)}")
+            continue
+        
+        clean_filename = sanitize_filename(filename)
+        logger.debug(f"💾 Extracted: {clean_filename}")
+        yield clean_filename, image_data
+
+def upload_extracted_image(bucket, image_key, image_data):
+    """Upload an extracted image to S3, using a multipart transfer for large files"""
+    content_type = f"image/{detect_image_format(image_data) or 'jpeg'}"
+    try:
+        if len(image_data) >= IMAGE_TRANSFER_CONFIG.multipart_threshold:
+            get_s3_client().upload_fileobj(
+                io.BytesIO(image_data),
+                bucket,
+                image_key,
+                ExtraArgs={'ContentType': content_type, 'ServerSideEncryption': 'AES256'},
+                Config=IMAGE_TRANSFER_CONFIG
+            )
+        else:
+            get_s3_client().put_object(
+                Bucket=bucket,
+                Key=image_key,
+                Body=image_data,
+                ContentType=content_type,
+                ServerSideEncryption='AES256'
+            )
+        logger.debug(f"✅ Uploaded: {image_key}")
+    except Exception as upload_error:
+        logger.error(f"❌ Failed to upload {image_key}: {str(upload_error)}")
+
+def extract_images_to_queue(zip_file, image_queue, worker_count, errors):
+    """Producer: walk the ZIP and queue (index, filename, data) for the workers"""
+    try:
+        for index, (filename, image_data) in enumerate(iter_image_entries(zip_file)):
+            image_queue.put((index, filename, image_data))
+    except Exception as e:
+        logger.error(f"❌ Error reading ZIP entries: {str(e)}")
+        errors.append(e)
+    finally:
+        # One sentinel per worker so every consumer shuts down
+        for _ in range(worker_count):
+            image_queue.put(None)
+
+def process_images_from_queue(bucket, extraction_folder, image_queue, result_queue, upload_executor):
+    """Consumer: count birds in queued images and upload them, reporting counts to result_queue"""
+    try:
+        finished = False
+        while not finished:
+            # Block for one image, then take whatever else is already waiting (up to the
+            # per-request limit) so a single Claude call covers several images
+            batch = []
+            item = image_queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= CLAUDE_IMAGES_PER_REQUEST:
+                    break
+                try:
+                    item = image_queue.get_nowait()
+                except queue.Empty:
+                    break
+            finished = item is None
+            if not batch:
                 continue
             
+            upload_futures = [
+                upload_executor.submit(upload_extracted_image, bucket, f"public/{extraction_folder}/{filename}", image_data)
+                for _, filename, image_data in batch
+            ]
             try:
-                image_data = zip_file.read(filename)
-                clean_filename = sanitize_filename(filename.split('/')[-1])
-                
-                image_files.append({
-                    'filename': clean_filename,
-                    'data': image_data
-                })
-                
-                logger.info(f"💾 Extracted: {clean_filename}")
+                bird_counts = process_image_batch(
+                    [(filename, image_data) for _, filename, image_data in batch], cache_bucket=bucket
+                )
             except Exception as e:
-                logger.error(f"❌ Error extracting {filename}: {str(e)}")
-    
-    logger.info(f"📊 Found {len(image_files)} image files to process")
+                logger.error(f"Error processing batch of {len(batch)} images: {str(e)}")
+                bird_counts = [0] * len(batch)
+            
+            # Wait for the uploads so the image bytes are released before taking more
+            concurrent.futures.wait(upload_futures)
+            for (index, filename, _), bird_count in zip(batch, bird_counts):
+                result_queue.put((index, filename, bird_count))
+    finally:
+        result_queue.put(None)
+
+def process_zip_file(bucket, key):
+    """Process ZIP file with security validations"""
+    import zipfile
     
-    # Process images in batches
-    results = []
+    logger.info(f"📦 Processing ZIP file: {key}")
     
-    for i in range(0, len(image_files), BATCH_SIZE):
-        batch = image_files[i:i + BATCH_SIZE]
-        logger.info(f"🔄 Processing batch {i // BATCH_SIZE + 1}/{(len(image_files) + BATCH_SIZE - 1) // BATCH_SIZE}")
-        
-        for file_data in batch:
-            try:
-                bird_count = process_image_with_claude(file_data['data'], file_data['filename'])
-                results.append((file_data['filename'], bird_count))
-            except Exception as e:
-                logger.error(f"Error processing {file_data['filename']}: {str(e)}")
-                results.append((file_data['filename'], 0))
+    # Reject oversized archives from their metadata before transferring any bytes
+    zip_size = get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+    if zip_size > MAX_FILE_SIZE:
+        logger.error(f"ZIP file too large: {key} is {zip_size} bytes")
+        raise ValueError(f"ZIP file exceeds maximum size of {MAX_FILE_SIZE} bytes: {zip_size}")
     
-    # Save extracted images to S3
     zip_name = key.split('/')[-1].replace('.zip', '').replace('.ZIP', '')
     extraction_folder = f"extracted/{sanitize_filename(zip_name)}-{datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S')}"
     
-    print(f"📤 Uploading {len(image_files)} images to S3: {extraction_folder}")
-    import sys
-    sys.stdout.flush()
+    # Download ZIP file from S3 - small archives stay in memory, large ones spill to /tmp
+    with SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_MEMORY) as zip_buffer:
+        get_s3_client().download_fileobj(bucket, key, zip_buffer)
+        zip_buffer.seek(0)
+        
+        # Validate ZIP file security
+        with zipfile.ZipFile(io.BufferedReader(zip_buffer, buffer_size=ZIP_READ_BUFFER_SIZE)) as zip_file:
+            is_valid, validation_message = validate_zip_security(zip_file)
+            if not is_valid:
+                logger.error(f"Security validation failed for {key}: {validation_message}")
+                raise ValueError(f"ZIP security validation failed: {validation_message}")
+            
+            # Producer/consumer pipeline: one thread walks the ZIP while workers count birds
+            # and upload, so at most PIPELINE_QUEUE_SIZE extracted images wait in memory
+            image_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            result_queue = queue.Queue()
+            producer_errors = []
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=S3_UPLOAD_PARALLELISM) as upload_executor:
+                producer = threading.Thread(
+                    target=extract_images_to_queue,
+                    args=(zip_file, image_queue, BEDROCK_PARALLELISM, producer_errors),
+                    daemon=True
+                )
+                workers = [
+                    threading.Thread(
+                        target=process_images_from_queue,
+                        args=(bucket, extraction_folder, image_queue, result_queue, upload_executor),
+                        daemon=True
+                    )
+                    for _ in range(BEDROCK_PARALLELISM)
+                ]
+                producer.start()
+                for worker in workers:
+                    worker.start()
+                
+                results = []
+                finished_workers = 0
+                while finished_workers < len(workers):
+                    item = result_queue.get()
+                    if item is None:
+                        finished_workers += 1
+                        continue
+                    results.append(item)
+                    if len(results) % PROGRESS_LOG_INTERVAL == 0:
+                        logger.info(f"🔄 Processed {len(results)} images into {extraction_folder}")
+                
+                producer.join()
+                for worker in workers:
+                    worker.join()
+            
+            if producer_errors:
+                raise producer_errors[0]
     
-    # Upload each image to S3
-    for file_data in image_files:
-        image_key = f"public/{extraction_folder}/{file_data['filename']}"
-        try:
-            s3.put_object(
-                Bucket=bucket,
-                Key=image_key,
-                Body=file_data['data'],
-                ContentType='image/jpeg',
-                ServerSideEncryption='AES256'
-            )
-            print(f"✅ Uploaded: {image_key}")
-        except Exception as upload_error:
-            print(f"❌ Failed to upload {image_key}: {str(upload_error)}")
+    # Workers finish out of order; restore ZIP order for the CSV
+    results = [(filename, bird_count) for _, filename, bird_count in sorted(results)]
     
-    sys.stdout.flush()
+    logger.info(f"📊 Processed {len(results)} image files from {key}")
     
     # Save results to CSV
     save_results_to_s3_csv(bucket, results, extraction_folder)
@@ -543,12 +753,12 @@ def process_single_image(bucket, key):
     logger.info(f"🕊️ Processing single image: {key}")
     
     # Download image from S3
-    s3_obj = s3.get_object(Bucket=bucket, Key=key)
+    s3_obj = get_s3_client().get_object(Bucket=bucket, Key=key)
     image_bytes = s3_obj["Body"].read()
     
     # Process with Claude
-    filename = sanitize_filename(key.split('/')[-1])
-    bird_count = process_image_with_claude(image_bytes, filename)
+    filename = sanitize_filename(key)
+    bird_count = process_image_with_claude(image_bytes, filename, cache_bucket=bucket)
     
     # Save result
     results = [(filename, bird_count)]
@@ -558,20 +768,14 @@ def process_single_image(bucket, key):
 
 def lambda_handler(event, context):
     """Main Lambda handler - UPDATED VERSION 4 - FIXED NOTEBOOK NAME"""
-    import sys
-    
-    # Use print and flush immediately
     print("🚀🚀🚀 UPDATED Lambda function started - VERSION 4 - FIXED NOTEBOOK NAME")
-    sys.stdout.flush()
     print(f"🪶 S3 Event Received with {len(event.get('Records', []))} records")
-    sys.stdout.flush()
     
     # Also try logger
     try:
         logger.info("🚀 Logger test")
     except Exception as log_error:
         print(f"❌ Logger error: {log_error}")
-        sys.stdout.flush()
     
     try:
         print(f"📊 Processing {len(event['Records'])} records")
@@ -1,6 +1,6 @@
 import { defineFunction } from '@aws-amplify/backend';
 import { Function, Runtime, Code } from 'aws-cdk-lib/aws-lambda';
-import { Duration } from 'aws-cdk-lib';
+import { Duration, Size } from 'aws-cdk-lib';
 import { Construct } from 'constructs';
 import * as path from 'path';
 import { fileURLToPath } from 'url';
@@ -15,9 +15,13 @@ export const birdProcessor = defineFunction((scope: Construct) => {
     code: Code.fromAsset(__dirname),
     timeout: Duration.minutes(15),
     memorySize: 1024,
+    ephemeralStorageSize: Size.gibibytes(10),
     environment: {
       BEDROCK_REGION: process.env.BEDROCK_REGION || 'us-west-2',
       CLAUDE_MODEL_ID: process.env.CLAUDE_MODEL_ID || 'global.anthropic.claude-sonnet-4-20250514-v1:0',
+      BEDROCK_PARALLELISM: process.env.BEDROCK_PARALLELISM || '16',
+      CLAUDE_IMAGES_PER_REQUEST: process.env.CLAUDE_IMAGES_PER_REQUEST || '5',
+      LOG_LEVEL: process.env.LOG_LEVEL || 'INFO',
       CONTAINER_IMAGE: process.env.CONTAINER_IMAGE || ''
     }
   });
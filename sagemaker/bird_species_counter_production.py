@@ -1,26 +1,39 @@
 #!/usr/bin/env python3
-import os
 import sys
 import json
 import logging
 import boto3
+from botocore.config import Config
+import numpy as np
+import orjson
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
 import io
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
-log_messages = []
+INFERENCE_WORKERS = 32  # Concurrent image downloads/endpoint invocations
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024  # Images larger than this are fetched in parallel byte ranges
+DOWNLOAD_RANGE_WORKERS = 32  # Shared pool for the remaining byte ranges of large images
+CONFIDENCE_LEVELS = ['low', 'medium', 'high']
 
-class LogCapture(logging.Handler):
-    def emit(self, record):
-        log_messages.append(self.format(record))
+LOG_FILE = '/tmp/bird_classification.log'  # Streamed to disk and uploaded to S3 at the end of the run
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-capture_handler = LogCapture()
-capture_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-logger.addHandler(capture_handler)
+file_handler = logging.FileHandler(LOG_FILE, mode='w')
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+logger.addHandler(file_handler)
+
+_SESSION = None
+
+def get_session():
+    # One session per run so every client shares the resolved credential chain
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = boto3.session.Session()
+    return _SESSION
 
 class BirdSpeciesClassifier:
     def __init__(self):
@@ -35,21 +48,44 @@ class BirdSpeciesClassifier:
             self.notebook_name = config['notebook_name']
             self.s3_region = config['s3_region']
             self.sagemaker_region = config['sagemaker_region']
+            # Optional: e.g. ml.g4dn.xlarge for a provisioned endpoint instead of serverless
+            self.endpoint_instance_type = config.get('endpoint_instance_type')
             
             logger.info(f"Loaded config: bucket={self.bucket_name}, model={self.model_name}, region={self.sagemaker_region}")
         except Exception as e:
             logger.error(f"Failed to load config from {config_path}: {str(e)}")
             raise
         
-        self.s3_client = boto3.client('s3', region_name=self.s3_region)
-        self.sagemaker_client = boto3.client('sagemaker', region_name=self.sagemaker_region)
-        self.sagemaker_runtime = boto3.client('sagemaker-runtime', region_name=self.sagemaker_region)
+        # Shared by all worker threads, so the connection pools must cover every inference
+        # worker plus the shared range pool; adaptive retries back off on endpoint/S3
+        # throttling across threads
+        client_config = Config(
+            max_pool_connections=INFERENCE_WORKERS + DOWNLOAD_RANGE_WORKERS,
+            retries={'max_attempts': 10, 'mode': 'adaptive'},
+            tcp_keepalive=True
+        )
+        session = get_session()
+        self.s3_client = session.client('s3', region_name=self.s3_region, config=client_config)
+        self.sagemaker_client = session.client('sagemaker', region_name=self.sagemaker_region)
+        self.sagemaker_runtime = session.client('sagemaker-runtime', region_name=self.sagemaker_region, config=client_config)
+        # The notebook lives in the stack region, which can differ from the model's region
+        if self.s3_region == self.sagemaker_region:
+            self.notebook_client = self.sagemaker_client
+        else:
+            self.notebook_client = session.client('sagemaker', region_name=self.s3_region)
+        
+        # One bounded pool for range reads keeps concurrent GETs within the S3 connection pool
+        self.range_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_RANGE_WORKERS)
         
         self.endpoint_name = None
+        self.endpoint_ready = None
         self.species_names = ['pigeon', 'dove', 'starling', 'sparrow', 'blackbird', 'crow']
+        self._conf_keys = [f'{s}_confidence' for s in self.species_names]
+        self._level_keys = [f'{s}_confidence_level' for s in self.species_names]
+        self._count_keys = [f'{s}_count' for s in self.species_names]
         logger.info(f"Initialized BirdSpeciesClassifier")
     
-    def create_serverless_endpoint(self):
+    def create_endpoint(self):
         try:
             timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
             endpoint_config_name = f'bird-endpoint-config-{timestamp}'
@@ -57,16 +93,26 @@ class BirdSpeciesClassifier:
             
             logger.info(f"Using model: {self.model_name}")
             
+            variant = {
+                'VariantName': 'AllTraffic',
+                'ModelName': self.model_name
+            }
+            if self.endpoint_instance_type:
+                # A provisioned instance serves many requests at once with no cold starts
+                logger.info(f"Using provisioned endpoint on {self.endpoint_instance_type}")
+                variant['InstanceType'] = self.endpoint_instance_type
+                variant['InitialInstanceCount'] = 1
+            else:
+                # The detection container takes one image per request, so throughput
+                # comes from concurrent invocations; more memory also buys more vCPU
+                variant['ServerlessConfig'] = {
+                    'MemorySizeInMB': 4096,
+                    'MaxConcurrency': INFERENCE_WORKERS
+                }
+            
             self.sagemaker_client.create_endpoint_config(
                 EndpointConfigName=endpoint_config_name,
-                ProductionVariants=[{
-                    'VariantName': 'AllTraffic',
-                    'ModelName': self.model_name,
-                    'ServerlessConfig': {
-                        'MemorySizeInMB': 2048,
-                        'MaxConcurrency': 1
-                    }
-                }]
+                ProductionVariants=[variant]
             )
             
             self.sagemaker_client.create_endpoint(
@@ -84,14 +130,20 @@ class BirdSpeciesClassifier:
             logger.error(f"Error creating endpoint: {str(e)}")
             return False
     
-    def classify_image(self, image_path):
+    def classify_image(self, image_bytes, image_key):
         try:
-            with Image.open(image_path) as img:
-                img = img.convert('RGB')
-                img = img.resize((224, 224))
-                img_bytes = io.BytesIO()
-                img.save(img_bytes, format='JPEG')
-                img_data = img_bytes.getvalue()
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                if img.format == 'JPEG' and img.mode == 'RGB' and img.size == (224, 224):
+                    # Already model-sized, so send the original bytes without a decode/encode round-trip
+                    img_data = image_bytes
+                else:
+                    # Let libjpeg downscale while decoding instead of decoding full resolution
+                    img.draft('RGB', (224, 224))
+                    img = img.convert('RGB')
+                    img = img.resize((224, 224), Image.Resampling.BILINEAR)
+                    img_bytes = io.BytesIO()
+                    img.save(img_bytes, format='JPEG')
+                    img_data = img_bytes.getvalue()
             
             response = self.sagemaker_runtime.invoke_endpoint(
                 EndpointName=self.endpoint_name,
@@ -99,38 +151,36 @@ class BirdSpeciesClassifier:
                 Body=img_data
             )
             
-            result = json.loads(response['Body'].read().decode())
+            result = orjson.loads(response['Body'].read())
             detections = result.get('prediction', [])
             
             # Aggregate detections by class_id
             # Format: [class_id, confidence, x1, y1, x2, y2]
-            species_confidences = [0.0] * 6
-            species_counts = [0] * 6
+            num_species = len(self.species_names)
+            detection_array = np.asarray(detections, dtype=np.float64).reshape(-1, 6)
+            class_ids = detection_array[:, 0].astype(np.int64)
+            confidences = detection_array[:, 1]
+            keep = (confidences > 0.3) & (class_ids >= 0) & (class_ids < num_species)
+            class_ids, confidences = class_ids[keep], confidences[keep]
             
-            for detection in detections:
-                class_id = int(detection[0])
-                confidence = float(detection[1])
-                
-                if 0 <= class_id < 6 and confidence > 0.3:
-                    species_confidences[class_id] = max(species_confidences[class_id], confidence)
-                    species_counts[class_id] += 1
+            species_counts = np.bincount(class_ids, minlength=num_species)
+            species_confidences = np.zeros(num_species)
+            np.maximum.at(species_confidences, class_ids, confidences)
             
-            logger.info(f"Processed {len(detections)} detections -> Confidences: {species_confidences}")
+            logger.info(f"Processed {len(detections)} detections -> Confidences: {species_confidences.tolist()}")
             
-            species_data = {}
-            for i, species in enumerate(self.species_names):
-                confidence = species_confidences[i] * 100
-                conf_level = 'high' if confidence >= 70 else 'medium' if confidence >= 50 else 'low'
-                
-                species_data[f'{species}_confidence'] = round(confidence, 2)
-                species_data[f'{species}_confidence_level'] = conf_level
-                species_data[f'{species}_count'] = species_counts[i]
+            # Levels follow the rounded value so they agree with the confidence written to the CSV
+            confs = np.round(species_confidences * 100, 2)
+            levels = np.where(confs >= 70, 'high', np.where(confs >= 50, 'medium', 'low'))
             
-            return species_data
+            return {
+                **dict(zip(self._conf_keys, confs.tolist())),
+                **dict(zip(self._level_keys, levels.tolist())),
+                **dict(zip(self._count_keys, species_counts.tolist()))
+            }
         except Exception as e:
-            logger.error(f"Error classifying {image_path}: {str(e)}")
-            return {f'{s}_{k}': 0.0 if k == 'confidence' else 'low' if k == 'confidence_level' else 0 
-                    for s in self.species_names for k in ['confidence', 'confidence_level', 'count']}
+            logger.error(f"Error classifying {image_key}: {str(e)}")
+            return {**dict.fromkeys(self._conf_keys, 0.0), **dict.fromkeys(self._level_keys, 'low'), **dict.fromkeys(self._count_keys, 0)}
     
     def cleanup_endpoint(self):
         try:
@@ -143,58 +193,100 @@ class BirdSpeciesClassifier:
     
     def discover_latest_csv_file(self):
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix='public/results/',
-                Delimiter='/'
-            )
-            
-            if 'Contents' not in response:
-                return None
-            
-            csv_files = [{'key': obj['Key'], 'last_modified': obj['LastModified']}
-                        for obj in response['Contents']
-                        if obj['Key'].endswith('.csv') and 'bird-results' in obj['Key']]
+            # Page through every result so the newest CSV is found past the first 1000 keys,
+            # keeping only the running latest instead of collecting and sorting them all
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            latest_csv = None
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix='public/results/bird-results', Delimiter='/'):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith('.csv') and (latest_csv is None or obj['LastModified'] > latest_csv['last_modified']):
+                        latest_csv = {'key': obj['Key'], 'last_modified': obj['LastModified']}
             
-            if not csv_files:
+            if latest_csv is None:
                 return None
             
-            latest_csv = sorted(csv_files, key=lambda x: x['last_modified'], reverse=True)[0]
             logger.info(f"Found CSV: {latest_csv['key']}")
             return latest_csv['key']
         except Exception as e:
             logger.error(f"Error discovering CSV: {str(e)}")
             return None
     
+    def _download_image(self, image_key):
+        # The first ranged GET doubles as the size probe, so typical images still take a
+        # single request; large ones fetch their remaining ranges in parallel
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=image_key, Range=f'bytes=0-{DOWNLOAD_RANGE_SIZE - 1}'
+        )
+        first_part = response['Body'].read()
+        total_size = int(response['ContentRange'].rsplit('/', 1)[1])
+        if total_size <= len(first_part):
+            return first_part
+        
+        def read_range(start):
+            end = min(start + DOWNLOAD_RANGE_SIZE, total_size) - 1
+            part = self.s3_client.get_object(Bucket=self.bucket_name, Key=image_key, Range=f'bytes={start}-{end}')
+            return part['Body'].read()
+        
+        starts = range(len(first_part), total_size, DOWNLOAD_RANGE_SIZE)
+        return first_part + b''.join(self.range_executor.map(read_range, starts))
+    
+    def _process_row(self, idx, folder, filename):
+        image_key = f"public/{folder}/{filename}"
+        
+        try:
+            if self.endpoint_ready.done() and not self.endpoint_ready.result():
+                return idx, None
+            
+            # Decode straight from memory rather than round-tripping through /tmp.
+            # Images fetched while the endpoint is still warming up wait here for it
+            image_bytes = self._download_image(image_key)
+            if not self.endpoint_ready.result():
+                return idx, None
+            
+            species_data = self.classify_image(image_bytes, image_key)
+            return idx, species_data
+        except Exception as e:
+            logger.warning(f"Error processing {image_key}: {str(e)}")
+            return idx, None
+    
     def process_csv_with_species(self, csv_key):
         try:
             response = self.s3_client.get_object(Bucket=self.bucket_name, Key=csv_key)
-            df = pd.read_csv(io.StringIO(response['Body'].read().decode('utf-8')))
+            df = pd.read_csv(response['Body'])
             logger.info(f"Processing {len(df)} rows")
             
-            for idx, row in df.iterrows():
-                image_key = f"public/{row['extraction_folder']}/{row['filename']}"
-                temp_image = f'/tmp/temp_image_{idx}.jpg'
-                
-                try:
-                    self.s3_client.download_file(self.bucket_name, image_key, temp_image)
-                    species_data = self.classify_image(temp_image)
-                    
-                    for key, value in species_data.items():
-                        df.at[idx, key] = value
-                    
-                    os.remove(temp_image)
-                except Exception as e:
-                    logger.warning(f"Error processing {image_key}: {str(e)}")
+            # Species columns are pre-allocated as typed arrays, filled by position and
+            # attached once instead of written cell by cell
+            n = len(df)
+            columns = {}
+            for conf_key, level_key, count_key in zip(self._conf_keys, self._level_keys, self._count_keys):
+                columns[conf_key] = np.zeros(n, dtype=np.float32)
+                columns[level_key] = np.full(n, 'low', dtype=object)
+                columns[count_key] = np.zeros(n, dtype=np.int32)
+            
+            # Downloads and endpoint calls are I/O bound, so rows are processed concurrently
+            with ThreadPoolExecutor(max_workers=INFERENCE_WORKERS) as executor:
+                for pos, species_data in executor.map(self._process_row, range(n), df['extraction_folder'].to_numpy(), df['filename'].to_numpy()):
+                    if species_data is not None:
+                        for key, value in species_data.items():
+                            columns[key][pos] = value
             
-            for species in self.species_names:
-                df[f'total_{species}_count'] = df[f'{species}_count'].sum()
+            if not self.endpoint_ready.result():
+                return None
+            
+            # Totals come straight from the count arrays, and species and total columns
+            # are attached in a single copy of the frame
+            for level_key in self._level_keys:
+                columns[level_key] = pd.Categorical(columns[level_key], categories=CONFIDENCE_LEVELS)
+            for species, count_key in zip(self.species_names, self._count_keys):
+                columns[f'total_{species}_count'] = int(columns[count_key].sum())
+            df = df.assign(**columns)
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             enhanced_csv = f'public/results/enhanced_bird_results_{timestamp}.csv'
             
-            csv_buffer = io.StringIO()
-            df.to_csv(csv_buffer, index=False)
+            csv_buffer = io.BytesIO()
+            df.to_csv(csv_buffer, index=False, encoding='utf-8')
             
             self.s3_client.put_object(
                 Bucket=self.bucket_name,
@@ -209,13 +301,23 @@ class BirdSpeciesClassifier:
             logger.error(f"Error processing CSV: {str(e)}")
             return None
     
+    def trigger_updated_since(self, since):
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key='triggers/run_classification')
+            return response['LastModified'] > since
+        except Exception as e:
+            logger.warning(f"Could not check classification trigger: {str(e)}")
+            return False
+    
     def run_pipeline(self):
         logger.info("Starting pipeline")
         
+        # Endpoint creation blocks for minutes, so it runs in the background while the
+        # CSV is found and loaded and the first images are downloaded
+        endpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self.endpoint_ready = endpoint_executor.submit(self.create_endpoint)
+        
         try:
-            if not self.create_serverless_endpoint():
-                return False
-            
             csv_key = self.discover_latest_csv_file()
             if not csv_key:
                 return False
@@ -226,6 +328,8 @@ class BirdSpeciesClassifier:
             logger.error(f"Pipeline error: {str(e)}")
             return False
         finally:
+            # Let creation finish so the endpoint is never left behind
+            endpoint_executor.shutdown(wait=True)
             self.cleanup_endpoint()
 
 def main():
@@ -233,6 +337,7 @@ def main():
     
     try:
         classifier = BirdSpeciesClassifier()
+        started_at = datetime.now(timezone.utc)
         success = classifier.run_pipeline()
         logger.info(f"Completed. Success: {success}")
     except Exception as e:
@@ -240,48 +345,43 @@ def main():
         success = False
     
     try:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        s3_client = boto3.client('s3', region_name=classifier.s3_region)
-        log_content = f"Completed at {timestamp}\nSuccess: {success}\n\n{'\n'.join(log_messages)}"
-        
-        s3_client.put_object(
-            Bucket=classifier.bucket_name,
-            Key=f'logs/bird_classification_{timestamp}.log',
-            Body=log_content,
-            ContentType='text/plain'
-        )
+        # Wait for notebook to be InService before stopping. The lifecycle script starts
+        # this run in the background, so this only waits for OnStart to return
+        waiter = classifier.notebook_client.get_waiter('notebook_instance_in_service')
+        waiter.wait(NotebookInstanceName=classifier.notebook_name, WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
     except Exception as e:
-        logger.warning(f"Could not upload log: {str(e)}")
+        logger.warning(f"Notebook did not reach InService: {str(e)}")
     
     try:
-        sagemaker = boto3.client('sagemaker', region_name=classifier.s3_region)
+        # The upload Lambda leaves a running notebook to pick up new results from the
+        # trigger file, so check it last, right before stopping, and process anything new
+        while classifier.trigger_updated_since(started_at):
+            logger.info("New classification trigger received, processing again")
+            started_at = datetime.now(timezone.utc)
+            success = classifier.run_pipeline()
+            logger.info(f"Completed. Success: {success}")
         
-        # Wait for notebook to be InService before stopping
-        max_attempts = 10
-        for attempt in range(max_attempts):
-            try:
-                response = sagemaker.describe_notebook_instance(NotebookInstanceName=classifier.notebook_name)
-                status = response['NotebookInstanceStatus']
-                
-                if status == 'InService':
-                    logger.info(f"Notebook is InService, stopping now...")
-                    sagemaker.stop_notebook_instance(NotebookInstanceName=classifier.notebook_name)
-                    logger.info("Notebook stop initiated successfully")
-                    break
-                else:
-                    logger.info(f"Notebook status: {status}, waiting... (attempt {attempt+1}/{max_attempts})")
-                    import time
-                    time.sleep(30)
-            except Exception as e:
-                logger.warning(f"Attempt {attempt+1} failed: {str(e)}")
-                if attempt < max_attempts - 1:
-                    import time
-                    time.sleep(30)
-                else:
-                    raise
+        logger.info("Stopping notebook now...")
+        classifier.notebook_client.stop_notebook_instance(NotebookInstanceName=classifier.notebook_name)
+        logger.info("Notebook stop initiated successfully")
     except Exception as e:
         logger.warning(f"Could not shutdown notebook: {str(e)}")
     
+    # Uploaded last so the log covers the shutdown; stopping takes minutes, this takes moments
+    try:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        logger.info(f"Completed at {timestamp}, Success: {success}")
+        file_handler.flush()
+        
+        classifier.s3_client.upload_file(
+            LOG_FILE,
+            classifier.bucket_name,
+            f'logs/bird_classification_{timestamp}.log',
+            ExtraArgs={'ContentType': 'text/plain'}
+        )
+    except Exception as e:
+        logger.warning(f"Could not upload log: {str(e)}")
+    
     sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
@@ -11,7 +11,7 @@ cd /home/ec2-user/SageMaker
 source /home/ec2-user/anaconda3/bin/activate
 
 echo "Installing packages..."
-pip install --quiet boto3 pandas pillow
+pip install --quiet boto3 pandas pillow orjson
 
 # Write configuration file
 cat > /home/ec2-user/SageMaker/config.json << 'CONFIG_EOF'
@@ -31,8 +31,10 @@ fi
 
 chmod +x bird_species_counter_production.py
 
-echo "Running production script..."
-python3 bird_species_counter_production.py
+# Run in the background: OnStart must finish within 5 minutes, and the script can only
+# see the notebook InService (and stop it) once this lifecycle script has returned
+echo "Running production script in the background..."
+nohup python3 bird_species_counter_production.py > /home/ec2-user/SageMaker/bird_species_counter.log 2>&1 &
 
 EOF
 